@@ -1,19 +1,97 @@
+import argparse
 import boto3
+from botocore.config import Config
+import hashlib
+import json
 import logging
+import os
+import tempfile
 from datetime import datetime
 import csv
+from contextlib import contextmanager
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
 
 logging.basicConfig(level=logging.INFO)
 
-def create_ou_dict(client, parent_id, parent_name, prefix=''):
-    """Creates a dictionary of OUs recursively based on the specified parent ID."""
-    ou_path = f'{prefix}/{parent_name}'.strip('/')
-    ou_dict = {parent_id: ou_path}
-    response = client.list_organizational_units_for_parent(ParentId=parent_id)
-    for ou in response.get('OrganizationalUnits', []):
-        ou_dict.update(create_ou_dict(client, ou.get('Id'), ou.get('Name'), ou_path))
+# Organizations caps MaxResults at 20 for these list operations
+PAGE_SIZE = 20
+MAX_WORKERS = 32
+CLIENT_CONFIG = Config(
+    retries={'mode': 'adaptive', 'max_attempts': 10},
+    max_pool_connections=MAX_WORKERS
+)
+OU_CACHE_PATH = './output/.ou_cache.json'
+
+@contextmanager
+def worker_pool():
+    """Provides a thread pool that cancels its queued work instead of running it when the block raises."""
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    try:
+        yield executor
+    except BaseException:
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+
+def build_ou_dict_parallel(client, root_id, root_ous=None):
+    """Creates a dictionary of OUs breadth-first from the root ID, listing each level concurrently."""
+    ou_dict = {root_id: 'root'}
+    queue = deque()
+
+    def add_children(parent_path, child_ous):
+        for ou in child_ous:
+            ou_path = f"{parent_path}/{ou.get('Name')}"
+            ou_dict[ou.get('Id')] = ou_path
+            queue.append((ou.get('Id'), ou_path))
+
+    add_children('root', get_child_ous(client, root_id) if root_ous is None else root_ous)
+    with worker_pool() as executor:
+        while queue:
+            level = [queue.popleft() for _ in range(len(queue))]
+            children = executor.map(lambda parent: get_child_ous(client, parent[0]), level)
+            for (_, parent_path), child_ous in zip(level, children):
+                add_children(parent_path, child_ous)
     return ou_dict
 
+def get_child_ous(client, parent_id):
+    """Gets the OUs directly under the specified parent ID."""
+    ous = []
+    paginator = client.get_paginator('list_organizational_units_for_parent')
+    for page in paginator.paginate(ParentId=parent_id, PaginationConfig={'PageSize': PAGE_SIZE}):
+        ous.extend(page.get('OrganizationalUnits', []))
+    return ous
+
+def load_ou_dict(client, root_id, refresh=False):
+    """Loads the OU dictionary from the local snapshot, rebuilding it if the top-level OUs have changed; also returns whether the snapshot was used."""
+    root_ous = get_child_ous(client, root_id)
+    top_level_ous = sorted([ou.get('Id'), ou.get('Name')] for ou in root_ous)
+    fingerprint = hashlib.sha256(json.dumps([root_id, top_level_ous]).encode()).hexdigest()
+    if not refresh:
+        try:
+            with open(OU_CACHE_PATH) as f:
+                cache = json.load(f)
+            if cache['fingerprint'] == fingerprint:
+                logging.info(f'-> loaded OU dictionary from {OU_CACHE_PATH}')
+                return cache['ou_dict'], True
+        except (OSError, ValueError, KeyError):
+            pass
+
+    ou_dict = build_ou_dict_parallel(client, root_id, root_ous)
+    try:
+        tmp = tempfile.NamedTemporaryFile('w', dir=os.path.dirname(OU_CACHE_PATH), delete=False)
+        try:
+            with tmp as f:
+                json.dump({'fingerprint': fingerprint, 'ou_dict': ou_dict}, f)
+            os.replace(tmp.name, OU_CACHE_PATH)
+        except BaseException:
+            os.remove(tmp.name)
+            raise
+    except OSError as e:
+        logging.warning(f'-> failed to write OU dictionary cache: {e}')
+    return ou_dict, False
+
 def get_org_root(client):
     """Retrieves the root ID of the organization."""
     response = client.list_roots()
@@ -21,41 +99,86 @@ def get_org_root(client):
 
 def get_accounts_for_parent(client, parent_id):
     """Gets AWS account information associated with the specified parent ID."""
-    response = client.list_accounts_for_parent(ParentId=parent_id)
-    return response.get('Accounts', [])
-
-def generate_accounts_csv(client, ou_dict, file_path):
-    """Outputs AWS account information to a CSV file"""
     accounts = []
-    for ou_id, ou_path in ou_dict.items():
-        logging.info(f'## searching accounts in {ou_path}...')
-        for account in get_accounts_for_parent(client, ou_id):
-            accounts.append([
-                account.get('Name'), account.get('Id'),
-                ou_path, ou_id,
-                account.get('Email'), account.get('Status'),
-                account.get('JoinedMethod'),
-                account.get('JoinedTimestamp').strftime('%Y/%m/%d %H:%M:%S')
-            ])
-    accounts.sort(key=lambda x: (x[0], x[2]))
+    paginator = client.get_paginator('list_accounts_for_parent')
+    for page in paginator.paginate(ParentId=parent_id, PaginationConfig={'PageSize': PAGE_SIZE}):
+        accounts.extend(page.get('Accounts', []))
+    return accounts
+
+def format_timestamp(dt):
+    """Formats a datetime as 'YYYY/MM/DD HH:MM:SS' without going through strftime."""
+    return f'{dt.year}/{dt.month:02d}/{dt.day:02d} {dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}'
+
+def iter_account_rows(client, ou_dict):
+    """Yields a CSV row for each AWS account under the OUs in the dictionary."""
+    def fetch(ou_id):
+        logging.info(f'## searching accounts in {ou_dict[ou_id]}...')
+        return get_accounts_for_parent(client, ou_id)
+
+    with worker_pool() as executor:
+        for (ou_id, ou_path), accounts in zip(ou_dict.items(), executor.map(fetch, ou_dict)):
+            for account in accounts:
+                yield [
+                    account.get('Name'), account.get('Id'),
+                    ou_path, ou_id,
+                    account.get('Email'), account.get('Status'),
+                    account.get('JoinedMethod'),
+                    format_timestamp(account.get('JoinedTimestamp'))
+                ]
 
+def count_accounts(client):
+    """Counts the AWS accounts in the organization."""
+    paginator = client.get_paginator('list_accounts')
+    return sum(len(page.get('Accounts', [])) for page in paginator.paginate(PaginationConfig={'PageSize': PAGE_SIZE}))
+
+def get_account_rows(client, ou_dict, verify=False):
+    """Gets CSV rows sorted by name and OU path; with verify, returns None if the OU dictionary is out of date."""
+    with worker_pool() as executor:
+        # Count in the background so the check overlaps the per-OU listings
+        account_count = executor.submit(count_accounts, client) if verify else None
+        try:
+            accounts = sorted(iter_account_rows(client, ou_dict), key=itemgetter(0, 2))
+        except client.exceptions.ParentNotFoundException:
+            if not verify:
+                raise
+            return None
+        # Accounts in OUs missing from the dictionary would otherwise be dropped silently
+        if verify and len(accounts) != account_count.result():
+            return None
+    return accounts
+
+def generate_accounts_csv(accounts, file_path):
+    """Outputs AWS account information to a CSV file"""
     header = ['Name', 'Id', 'OU Path', 'OU ID', 'Email', 'Status', 'JoinedMethod', 'JoinedTimestamp']
     with open(file_path, 'w', newline='') as csvfile:
         writer = csv.writer(csvfile, quoting=csv.QUOTE_ALL)
-        writer.writerows([header] + accounts)
+        writer.writerow(header)
+        writer.writerows(accounts)
 
 def main():
-    client = boto3.client('organizations')
+    parser = argparse.ArgumentParser(description='Outputs AWS account information to a CSV file')
+    parser.add_argument('--refresh-cache', action='store_true', help='rebuild the cached OU dictionary')
+    args = parser.parse_args()
+
+    session = boto3.session.Session()
+    client = session.client('organizations', config=CLIENT_CONFIG)
     datetime_now = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
     file_path = f'./output/accounts_{datetime_now}.csv'
     logging.info(f'[start] timestamp: {datetime_now}')
 
     logging.info('# getting OU dictionary...')
-    ou_dict = create_ou_dict(client, get_org_root(client), 'root')
+    root_id = get_org_root(client)
+    ou_dict, cached = load_ou_dict(client, root_id, refresh=args.refresh_cache)
     logging.info(f'-> number of OUs: {len(ou_dict)}')
 
     logging.info('# creating AWS accounts list and generating CSV...')
-    generate_accounts_csv(client, ou_dict, file_path)
+    accounts = get_account_rows(client, ou_dict, verify=cached)
+    if accounts is None:
+        logging.warning('-> cached OU dictionary is out of date, rebuilding...')
+        ou_dict, _ = load_ou_dict(client, root_id, refresh=True)
+        logging.info(f'-> number of OUs: {len(ou_dict)}')
+        accounts = get_account_rows(client, ou_dict)
+    generate_accounts_csv(accounts, file_path)
 
     logging.info('[end]')
 
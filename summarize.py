@@ -1,16 +1,49 @@
+import hashlib
+import json
 import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from itertools import product
 from operator import itemgetter
 from typing import Dict, List, Tuple
 
 import boto3
+from botocore.config import Config
 from tabulate import tabulate
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # Constants
-TEMPLATE = """# AWS IAM Identity Center Inventory
+MAX_WORKERS = 32
+# Size the connection pool to the worker count so threads don't wait on sockets,
+# and let adaptive retries rate-limit client-side when the APIs start throttling
+CLIENT_CONFIG = Config(
+    retries={'mode': 'adaptive', 'max_attempts': 10},
+    max_pool_connections=MAX_WORKERS
+)
+
+# Client-side request rates (requests per second), kept under the service throttling limits
+SSO_ADMIN_RATE = 20
+IDENTITY_STORE_RATE = 20
+
+# Maximum page size accepted by each list API
+LIST_ACCOUNTS_PAGE = 20
+LIST_USERS_PAGE = 100
+LIST_GROUPS_PAGE = 100
+LIST_GROUP_MEMBERSHIPS_PAGE = 100
+LIST_PERMISSION_SETS_PAGE = 100
+LIST_PROVISIONED_ACCOUNTS_PAGE = 100
+LIST_ACCOUNT_ASSIGNMENTS_PAGE = 100
+
+# Kept under output/ so the cache survives across 'docker compose run' containers
+IDENTITY_CACHE_DIR = 'output/.cache'
+IDENTITY_CACHE_TTL = 24 * 60 * 60
+
+REPORT_HEADER = """# AWS IAM Identity Center Inventory
 
 - Retrieved at: {datetime}
 - Executed Account: {account_name} ({account_id})
@@ -19,31 +52,73 @@ TEMPLATE = """# AWS IAM Identity Center Inventory
 
 - Instance ARN: {instance_arn}
 - Identity Store ID: {identity_store_id}
+"""
 
-## AWS Accounts
+SECTION_TEMPLATE = """
+## {title}
 
-{accounts}
+{table}
+"""
 
-## Users
 
-{users}
+def write_section(f, title: str, rows, headers: List[str]) -> None:
+    """
+    Writes a tabulated report section to the file.
 
-## Groups
+    Args:
+        f: The file object to write to.
+        title (str): The title of the section.
+        rows: The rows of the table.
+        headers (List[str]): The column headers of the table.
+    """
+    f.write(SECTION_TEMPLATE.format(title=title, table=tabulate(rows, headers=headers, tablefmt='github')))
 
-{groups}
 
-## Group Memberships
+@contextmanager
+def worker_pool():
+    """
+    Provides a thread pool that cancels its queued work instead of running it when the block raises.
 
-{group_memberships}
+    Yields:
+        ThreadPoolExecutor: The thread pool.
+    """
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    try:
+        yield executor
+    except BaseException:
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
 
-## Permission Sets
 
-{permission_sets}
+class TokenBucket:
+    """
+    Thread-safe token bucket that paces requests sent by a boto3 client.
+    """
 
-## Assignments
+    def __init__(self, rate: float):
+        """
+        Args:
+            rate (float): The sustained number of requests per second, also used as the burst size.
+        """
+        self.rate = rate
+        self.tokens = rate
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
 
-{assignments}
-"""
+    def acquire(self, **kwargs) -> None:
+        """
+        Takes a token, sleeping until one is available. Registered as a botocore 'before-send' handler.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            # Going negative reserves the next free slot, so waiting threads are served in order
+            self.tokens -= 1
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
 
 
 class IdentityCenterInventory:
@@ -52,19 +127,59 @@ class IdentityCenterInventory:
     """
 
     def __init__(self):
-        self.org_client = boto3.client('organizations')
-        self.idstore_client = boto3.client('identitystore')
-        self.ssoadmin_client = boto3.client('sso-admin')
-        self.sts_client = boto3.client('sts')
+        self._session = boto3.session.Session()
+        self.org_client = self._session.client('organizations', config=CLIENT_CONFIG)
+        self.idstore_client = self._session.client('identitystore', config=CLIENT_CONFIG)
+        self.ssoadmin_client = self._session.client('sso-admin', config=CLIENT_CONFIG)
+        self.sts_client = self._session.client('sts', config=CLIENT_CONFIG)
+        self._idstore_limiter = TokenBucket(IDENTITY_STORE_RATE)
+        self._ssoadmin_limiter = TokenBucket(SSO_ADMIN_RATE)
+        self.idstore_client.meta.events.register('before-send', self._idstore_limiter.acquire)
+        self.ssoadmin_client.meta.events.register('before-send', self._ssoadmin_limiter.acquire)
 
         self.accounts = []
         self.account_id_to_name = {}
-        self.users = []
         self.user_id_to_name = {}
-        self.groups = []
         self.group_id_to_name = {}
-        self.permission_sets = []
         self.permission_set_arn_to_name = {}
+        self._placeholder_names = {}
+
+    def fetch_caller_account_id(self) -> str:
+        """
+        Fetches the ID of the account the credentials belong to, cached on disk per credentials.
+
+        Returns:
+            str: The ID of the executing AWS account.
+        """
+        credentials = self._session.get_credentials()
+        cache_key = '\0'.join([
+            os.environ.get('AWS_PROFILE', ''),
+            credentials.access_key if credentials else ''
+        ])
+        config_hash = hashlib.sha256(cache_key.encode()).hexdigest()[:16]
+        cache_path = os.path.join(IDENTITY_CACHE_DIR, f'identity-{config_hash}.json')
+
+        try:
+            if time.time() - os.path.getmtime(cache_path) < IDENTITY_CACHE_TTL:
+                with open(cache_path, encoding='utf-8') as f:
+                    return json.load(f)['Account']
+        except (OSError, ValueError, KeyError):
+            pass
+
+        account_id = self.sts_client.get_caller_identity()['Account']
+        try:
+            os.makedirs(IDENTITY_CACHE_DIR, exist_ok=True)
+            tmp = tempfile.NamedTemporaryFile('w', dir=IDENTITY_CACHE_DIR, delete=False, encoding='utf-8')
+            try:
+                with tmp as f:
+                    json.dump({'Account': account_id}, f)
+                os.replace(tmp.name, cache_path)
+            except BaseException:
+                os.remove(tmp.name)
+                raise
+        except OSError as e:
+            logging.warning(f'Failed to write identity cache: {e}')
+        return account_id
 
     def fetch_accounts(self) -> None:
         """
@@ -72,7 +187,7 @@ class IdentityCenterInventory:
         """
         logging.info('Fetching AWS accounts...')
         paginator = self.org_client.get_paginator('list_accounts')
-        for page in paginator.paginate():
+        for page in paginator.paginate(PaginationConfig={'PageSize': LIST_ACCOUNTS_PAGE}):
             self.accounts.extend(page['Accounts'])
         self.account_id_to_name = {account['Id']: account['Name'] for account in self.accounts}
         logging.info(f'Number of accounts: {len(self.account_id_to_name)}')
@@ -86,9 +201,11 @@ class IdentityCenterInventory:
         """
         logging.info('Fetching users...')
         paginator = self.idstore_client.get_paginator('list_users')
-        for page in paginator.paginate(IdentityStoreId=identity_store_id):
-            self.users.extend(page['Users'])
-        self.user_id_to_name = {user['UserId']: user['DisplayName'] for user in self.users}
+        self.user_id_to_name = {
+            user['UserId']: user['DisplayName']
+            for page in paginator.paginate(IdentityStoreId=identity_store_id, PaginationConfig={'PageSize': LIST_USERS_PAGE})
+            for user in page['Users']
+        }
         logging.info(f'Number of users: {len(self.user_id_to_name)}')
 
     def fetch_groups(self, identity_store_id: str) -> None:
@@ -100,9 +217,11 @@ class IdentityCenterInventory:
         """
         logging.info('Fetching groups...')
         paginator = self.idstore_client.get_paginator('list_groups')
-        for page in paginator.paginate(IdentityStoreId=identity_store_id):
-            self.groups.extend(page['Groups'])
-        self.group_id_to_name = {group['GroupId']: group['DisplayName'] for group in self.groups}
+        self.group_id_to_name = {
+            group['GroupId']: group['DisplayName']
+            for page in paginator.paginate(IdentityStoreId=identity_store_id, PaginationConfig={'PageSize': LIST_GROUPS_PAGE})
+            for group in page['Groups']
+        }
         logging.info(f'Number of groups: {len(self.group_id_to_name)}')
 
     def fetch_permission_sets(self, instance_arn: str) -> None:
@@ -115,15 +234,17 @@ class IdentityCenterInventory:
         logging.info('Fetching permission sets...')
         paginator = self.ssoadmin_client.get_paginator('list_permission_sets')
         permission_set_arns = []
-        for page in paginator.paginate(InstanceArn=instance_arn):
+        for page in paginator.paginate(InstanceArn=instance_arn, PaginationConfig={'PageSize': LIST_PERMISSION_SETS_PAGE}):
             permission_set_arns.extend(page['PermissionSets'])
 
-        for arn in permission_set_arns:
-            permission_set = self.ssoadmin_client.describe_permission_set(
-                InstanceArn=instance_arn, PermissionSetArn=arn
-            )['PermissionSet']
-            self.permission_sets.append(permission_set)
-            self.permission_set_arn_to_name[arn] = permission_set['Name']
+        # list_permission_sets returns ARNs only, so the names still need a describe call each
+        with worker_pool() as executor:
+            self.permission_set_arn_to_name = dict(zip(permission_set_arns, executor.map(
+                lambda arn: self.ssoadmin_client.describe_permission_set(
+                    InstanceArn=instance_arn, PermissionSetArn=arn
+                )['PermissionSet']['Name'],
+                permission_set_arns
+            )))
 
         logging.info(f'Number of permission sets: {len(self.permission_set_arn_to_name)}')
 
@@ -138,17 +259,42 @@ class IdentityCenterInventory:
             List[Tuple[str, str]]: A list of tuples (group_name, user_name) representing group memberships.
         """
         logging.info('Fetching group memberships...')
-        memberships = []
-        for group_id, group_name in self.group_id_to_name.items():
-            paginator = self.idstore_client.get_paginator('list_group_memberships')
-            for page in paginator.paginate(IdentityStoreId=identity_store_id, GroupId=group_id):
-                for membership in page['GroupMemberships']:
-                    user_id = membership['MemberId']['UserId']
-                    user_name = self.user_id_to_name.get(user_id, f'#DELETED({user_id})')
-                    memberships.append((group_name, user_name))
+        with worker_pool() as executor:
+            results = executor.map(
+                lambda group_id: self._fetch_group_memberships_for(identity_store_id, group_id),
+                self.group_id_to_name.keys()
+            )
+            memberships = [membership for result in results for membership in result]
         logging.info(f'Number of group memberships: {len(memberships)}')
         return memberships
 
+    def _fetch_group_memberships_for(self, identity_store_id: str, group_id: str) -> List[Tuple[str, str]]:
+        """
+        Fetches memberships of a single group from the specified Identity Store.
+
+        Args:
+            identity_store_id (str): The ID of the Identity Store.
+            group_id (str): The ID of the group.
+
+        Returns:
+            List[Tuple[str, str]]: A list of tuples (group_name, user_name) representing group memberships.
+        """
+        group_name = self.group_id_to_name[group_id]
+        user_lookup = self.user_id_to_name.get
+        memberships = []
+        paginator = self.idstore_client.get_paginator('list_group_memberships')
+        for page in paginator.paginate(
+            IdentityStoreId=identity_store_id, GroupId=group_id,
+            PaginationConfig={'PageSize': LIST_GROUP_MEMBERSHIPS_PAGE}
+        ):
+            for membership in page['GroupMemberships']:
+                user_id = membership['MemberId']['UserId']
+                user_name = user_lookup(user_id)
+                if user_name is None:
+                    user_name = self._placeholder_name('DELETED', user_id)
+                memberships.append((group_name, user_name))
+        return memberships
+
     def fetch_assignments(self, instance_arn: str) -> List[Tuple[str, str, str, str]]:
         """
         Fetches account assignments for the specified IAM Identity Center instance.
@@ -161,25 +307,97 @@ class IdentityCenterInventory:
         """
         logging.info('Fetching account assignments...')
         assignments = []
-        for account_id, permission_set_arn in product(self.account_id_to_name.keys(), self.permission_set_arn_to_name.keys()):
-            account_name = self.account_id_to_name[account_id]
-            permission_set_name = self.permission_set_arn_to_name[permission_set_arn]
-            logging.info(f'Fetching assignments for {account_name}, {permission_set_name}...')
-            paginator = self.ssoadmin_client.get_paginator('list_account_assignments')
-            for page in paginator.paginate(InstanceArn=instance_arn, AccountId=account_id, PermissionSetArn=permission_set_arn):
-                for assignment in page['AccountAssignments']:
-                    principal_type = assignment['PrincipalType']
-                    principal_id = assignment['PrincipalId']
-                    if principal_type == 'USER':
-                        principal_name = self.user_id_to_name.get(principal_id, f'#DELETED({principal_id})')
-                    elif principal_type == 'GROUP':
-                        principal_name = self.group_id_to_name.get(principal_id, f'#DELETED({principal_id})')
-                    else:
-                        principal_name = f'#UNKNOWN({principal_id})'
-                    assignments.append((account_name, principal_type, principal_name, permission_set_name))
+        with worker_pool() as executor:
+            provisioned_futures = {
+                executor.submit(self._fetch_provisioned_account_ids, instance_arn, arn): arn
+                for arn in self.permission_set_arn_to_name.keys()
+            }
+            # Queue each permission set's pairs as soon as its accounts are known
+            assignment_futures = []
+            for future in as_completed(provisioned_futures):
+                permission_set_arn = provisioned_futures[future]
+                assignment_futures.extend(
+                    executor.submit(self._fetch_assignments_for, instance_arn, account_id, permission_set_arn)
+                    for account_id in future.result()
+                    if account_id in self.account_id_to_name
+                )
+            for future in as_completed(assignment_futures):
+                assignments.extend(future.result())
         logging.info(f'Number of assignments: {len(assignments)}')
         return assignments
 
+    def _fetch_provisioned_account_ids(self, instance_arn: str, permission_set_arn: str) -> List[str]:
+        """
+        Fetches the IDs of the accounts the specified permission set is provisioned to.
+
+        Args:
+            instance_arn (str): The ARN of the IAM Identity Center instance.
+            permission_set_arn (str): The ARN of the permission set.
+
+        Returns:
+            List[str]: A list of account IDs.
+        """
+        account_ids = []
+        paginator = self.ssoadmin_client.get_paginator('list_accounts_for_provisioned_permission_set')
+        for page in paginator.paginate(
+            InstanceArn=instance_arn, PermissionSetArn=permission_set_arn,
+            PaginationConfig={'PageSize': LIST_PROVISIONED_ACCOUNTS_PAGE}
+        ):
+            account_ids.extend(page['AccountIds'])
+        return account_ids
+
+    def _fetch_assignments_for(self, instance_arn: str, account_id: str, permission_set_arn: str) -> List[Tuple[str, str, str, str]]:
+        """
+        Fetches account assignments for a single account and permission set pair.
+
+        Args:
+            instance_arn (str): The ARN of the IAM Identity Center instance.
+            account_id (str): The ID of the AWS account.
+            permission_set_arn (str): The ARN of the permission set.
+
+        Returns:
+            List[Tuple[str, str, str, str]]: A list of tuples (account_name, principal_type, principal_name, permission_set_name) representing assignments.
+        """
+        account_name = self.account_id_to_name[account_id]
+        permission_set_name = self.permission_set_arn_to_name[permission_set_arn]
+        logging.info(f'Fetching assignments for {account_name}, {permission_set_name}...')
+        principal_lookups = {'USER': self.user_id_to_name.get, 'GROUP': self.group_id_to_name.get}
+        assignments = []
+        paginator = self.ssoadmin_client.get_paginator('list_account_assignments')
+        for page in paginator.paginate(
+            InstanceArn=instance_arn, AccountId=account_id, PermissionSetArn=permission_set_arn,
+            PaginationConfig={'PageSize': LIST_ACCOUNT_ASSIGNMENTS_PAGE}
+        ):
+            for assignment in page['AccountAssignments']:
+                principal_type = assignment['PrincipalType']
+                principal_id = assignment['PrincipalId']
+                lookup = principal_lookups.get(principal_type)
+                if lookup is None:
+                    principal_name = self._placeholder_name('UNKNOWN', principal_id)
+                else:
+                    principal_name = lookup(principal_id)
+                    if principal_name is None:
+                        principal_name = self._placeholder_name('DELETED', principal_id)
+                assignments.append((account_name, principal_type, principal_name, permission_set_name))
+        return assignments
+
+    def _placeholder_name(self, kind: str, principal_id: str) -> str:
+        """
+        Returns the placeholder name for a principal that cannot be resolved, building it once per principal.
+
+        Args:
+            kind (str): The placeholder kind, e.g. 'DELETED' or 'UNKNOWN'.
+            principal_id (str): The ID of the principal.
+
+        Returns:
+            str: The placeholder name in the form '#KIND(principal_id)'.
+        """
+        key = (kind, principal_id)
+        name = self._placeholder_names.get(key)
+        if name is None:
+            name = self._placeholder_names.setdefault(key, f'#{kind}({principal_id})')
+        return name
+
     def generate_report(self) -> None:
         """
         Generates the inventory report and saves it to a file.
@@ -189,7 +407,7 @@ class IdentityCenterInventory:
 
         # Fetch account information
         self.fetch_accounts()
-        exec_account_id = self.sts_client.get_caller_identity()['Account']
+        exec_account_id = self.fetch_caller_account_id()
         exec_account_name = self.account_id_to_name.get(exec_account_id, 'Unknown')
 
         # Fetch IAM Identity Center instance information
@@ -211,57 +429,50 @@ class IdentityCenterInventory:
         group_memberships = self.fetch_group_memberships(identity_store_id)
         assignments = self.fetch_assignments(instance_arn)
 
-        # Generate tabulated data
-        accounts_table = tabulate(
-            sorted([(name, account_id) for account_id, name in self.account_id_to_name.items()], key=itemgetter(0)),
-            headers=['Account Name', 'Account ID'],
-            tablefmt='github'
-        )
-        users_table = tabulate(
-            sorted([(display_name, user_name, user_id) for user_id, display_name in self.user_id_to_name.items() for user_name, user_id in [(None, user_id)]], key=itemgetter(0, 1)),
-            headers=['Display Name', 'User Name', 'User ID'],
-            tablefmt='github'
-        )
-        groups_table = tabulate(
-            sorted([(display_name, description, group_id) for group_id, display_name in self.group_id_to_name.items() for description, group_id in [(None, group_id)]], key=itemgetter(0)),
-            headers=['Display Name', 'Description', 'Group ID'],
-            tablefmt='github'
-        )
-        group_memberships_table = tabulate(
-            sorted(group_memberships, key=itemgetter(0, 1)),
-            headers=['Group Name', 'User Name'],
-            tablefmt='github'
-        )
-        permission_sets_table = tabulate(
-            sorted([(name, description, arn) for arn, name in self.permission_set_arn_to_name.items() for description, arn in [(None, arn)]], key=itemgetter(0)),
-            headers=['Permission Set Name', 'Description', 'Permission Set ARN'],
-            tablefmt='github'
-        )
-        assignments_table = tabulate(
-            sorted(assignments, key=itemgetter(0, 1, 2)),
-            headers=['Account Name', 'Principal Type', 'Principal Name', 'Permission Set Name'],
-            tablefmt='github'
-        )
-
-        # Generate report
-        report = TEMPLATE.format(
-            datetime=now,
-            instance_arn=instance_arn,
-            identity_store_id=identity_store_id,
-            account_name=exec_account_name,
-            account_id=exec_account_id,
-            accounts=accounts_table,
-            users=users_table,
-            groups=groups_table,
-            group_memberships=group_memberships_table,
-            permission_sets=permission_sets_table,
-            assignments=assignments_table
-        )
-
-        # Save report to file
+        # Write report to file section by section
         file_path = f'output/inventory_{now}.md'
         with open(file_path, 'w', encoding='utf-8') as f:
-            f.write(report)
+            f.write(REPORT_HEADER.format(
+                datetime=now,
+                instance_arn=instance_arn,
+                identity_store_id=identity_store_id,
+                account_name=exec_account_name,
+                account_id=exec_account_id
+            ))
+            write_section(
+                f, 'AWS Accounts',
+                sorted([(name, account_id) for account_id, name in self.account_id_to_name.items()], key=itemgetter(0)),
+                ['Account Name', 'Account ID']
+            )
+            write_section(
+                f, 'Users',
+                sorted(((display_name, None, user_id) for user_id, display_name in self.user_id_to_name.items()), key=itemgetter(0)),
+                ['Display Name', 'User Name', 'User ID']
+            )
+            write_section(
+                f, 'Groups',
+                sorted(((display_name, None, group_id) for group_id, display_name in self.group_id_to_name.items()), key=itemgetter(0)),
+                ['Display Name', 'Description', 'Group ID']
+            )
+            group_memberships.sort()
+            write_section(
+                f, 'Group Memberships',
+                group_memberships,
+                ['Group Name', 'User Name']
+            )
+            write_section(
+                f, 'Permission Sets',
+                sorted(((name, None, arn) for arn, name in self.permission_set_arn_to_name.items()), key=itemgetter(0)),
+                ['Permission Set Name', 'Description', 'Permission Set ARN']
+            )
+            # Sort on the whole tuple: no key tuples are built, and ties on the first
+            # three columns no longer depend on the order fetches completed in
+            assignments.sort()
+            write_section(
+                f, 'Assignments',
+                assignments,
+                ['Account Name', 'Principal Type', 'Principal Name', 'Permission Set Name']
+            )
         logging.info(f'Inventory report saved to {file_path}')
 
 